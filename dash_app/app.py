@@ -12,16 +12,28 @@
 import base64
 import csv
 import io
+import re
+import threading
+import uuid
+from functools import lru_cache
 
 import numpy as np
+from numba import njit, prange
 from PIL import Image
-from scipy.ndimage import median_filter
 
 import dash
 from dash import dcc, html, dash_table, no_update, ctx
 from dash.dependencies import Input, Output, State
+from flask_caching import Cache
 import plotly.graph_objects as go
 
+# JPEG の高速デコード (任意依存: PyTurboJPEG + libjpeg-turbo)
+try:
+    from turbojpeg import TurboJPEG, TJCS_GRAY, TJPF_GRAY
+    _turbo_jpeg = TurboJPEG()
+except Exception:  # 未導入 / ライブラリが見つからない場合は PIL のみ
+    _turbo_jpeg = None
+
 
 # ============================================================
 #  Image Processing Functions
@@ -30,72 +42,253 @@ import plotly.graph_objects as go
 def decode_upload_to_gray(contents: str) -> np.ndarray:
     """dcc.Upload の contents → グレースケール ndarray."""
     _, b64 = contents.split(",", 1)
-    img = Image.open(io.BytesIO(base64.b64decode(b64)))
+    raw = base64.b64decode(b64)
+    if _turbo_jpeg is not None and raw[:2] == b"\xff\xd8":
+        # 元からグレースケールの JPEG のみ。カラー JPEG の Y 面は PIL の
+        # convert("L") と ±1 ずれ、白画素数が環境依存になるため PIL に任せる
+        try:
+            if _turbo_jpeg.decode_header(raw)[3] == TJCS_GRAY:
+                return _turbo_jpeg.decode(
+                    raw, pixel_format=TJPF_GRAY)[:, :, 0]
+        except Exception:  # 壊れたヘッダ等は PIL にフォールバック
+            pass
+    img = Image.open(io.BytesIO(raw))
     return np.array(img.convert("L"))
 
 
-def arr_to_b64(arr: np.ndarray) -> str:
-    """ndarray → base64 PNG (Store 保存用)."""
-    buf = io.BytesIO()
-    Image.fromarray(arr.astype(np.uint8)).save(buf, format="PNG")
-    return base64.b64encode(buf.getvalue()).decode()
+def arr_to_b64(arr: np.ndarray) -> dict:
+    """ndarray → {"b64": 生バイト列の base64, "shape": (h, w)} (Store 保存用).
+
+    PNG 圧縮を挟まず uint8 のバッファをそのまま格納する。
+    """
+    arr = np.ascontiguousarray(arr, dtype=np.uint8)
+    return {"b64": base64.b64encode(arr.tobytes()).decode(),
+            "shape": list(arr.shape)}
+
+
+_tls = threading.local()
+
+
+def _png_buffer() -> io.BytesIO:
+    """スレッドごとに使い回す PNG エンコード用バッファ (空にして返す)."""
+    buf = getattr(_tls, "buf", None)
+    if buf is None:
+        buf = _tls.buf = io.BytesIO()
+    buf.seek(0)
+    buf.truncate()
+    return buf
 
 
-def b64_to_arr(b64str: str) -> np.ndarray:
-    """base64 PNG → ndarray."""
-    return np.array(
-        Image.open(io.BytesIO(base64.b64decode(b64str))).convert("L")
+def arr_to_png_b64(arr: np.ndarray) -> str:
+    """ndarray → base64 PNG.
+
+    表示用の一時的な画像なので zlib 圧縮レベル 1 で保存する (サイズより速度優先)。
+    """
+    buf = _png_buffer()
+    Image.fromarray(arr.astype(np.uint8)).save(
+        buf, format="PNG", compress_level=1
     )
+    return base64.b64encode(buf.getvalue()).decode()
 
 
 def arr_to_data_uri(arr: np.ndarray) -> str:
     """ndarray → data:image/png;base64,… (html.Img src 用)."""
-    return f"data:image/png;base64,{arr_to_b64(arr)}"
-
+    return f"data:image/png;base64,{arr_to_png_b64(arr)}"
 
-def apply_median(arr: np.ndarray, kernel_size: int) -> np.ndarray:
-    return median_filter(arr, size=kernel_size).astype(np.uint8)
 
+@njit(cache=True, parallel=True)
+def median3x3_u8(padded: np.ndarray) -> np.ndarray:
+    """3×3 メディアン (9 入力ソーティングネットワーク, 19 回の比較交換).
 
-def compute_histogram(arr: np.ndarray) -> list:
-    return np.bincount(arr.flatten(), minlength=256).tolist()
+    padded は上下左右に 1 画素ずつパディング済みの uint8 配列。
+    """
+    h, w = padded.shape[0] - 2, padded.shape[1] - 2
+    out = np.empty((h, w), dtype=np.uint8)
+    for y in prange(h):
+        for x in range(w):
+            p0 = padded[y, x]
+            p1 = padded[y, x + 1]
+            p2 = padded[y, x + 2]
+            p3 = padded[y + 1, x]
+            p4 = padded[y + 1, x + 1]
+            p5 = padded[y + 1, x + 2]
+            p6 = padded[y + 2, x]
+            p7 = padded[y + 2, x + 1]
+            p8 = padded[y + 2, x + 2]
+            p1, p2 = min(p1, p2), max(p1, p2)
+            p4, p5 = min(p4, p5), max(p4, p5)
+            p7, p8 = min(p7, p8), max(p7, p8)
+            p0, p1 = min(p0, p1), max(p0, p1)
+            p3, p4 = min(p3, p4), max(p3, p4)
+            p6, p7 = min(p6, p7), max(p6, p7)
+            p1, p2 = min(p1, p2), max(p1, p2)
+            p4, p5 = min(p4, p5), max(p4, p5)
+            p7, p8 = min(p7, p8), max(p7, p8)
+            p0, p3 = min(p0, p3), max(p0, p3)
+            p5, p8 = min(p5, p8), max(p5, p8)
+            p4, p7 = min(p4, p7), max(p4, p7)
+            p3, p6 = min(p3, p6), max(p3, p6)
+            p1, p4 = min(p1, p4), max(p1, p4)
+            p2, p5 = min(p2, p5), max(p2, p5)
+            p4, p7 = min(p4, p7), max(p4, p7)
+            p4, p2 = min(p4, p2), max(p4, p2)
+            p6, p4 = min(p6, p4), max(p6, p4)
+            p4, p2 = min(p4, p2), max(p4, p2)
+            out[y, x] = p4
+    return out
+
+
+@njit(cache=True, parallel=True)
+def _median_kxk_u8(padded: np.ndarray, k: int) -> np.ndarray:
+    """k×k メディアン (行ごとのスライディングヒストグラム, Huang 法).
+
+    uint8 なので 256 ビンのヒストグラムで窓内の順位を保持し、
+    1 画素進むごとに左端列を除き右端列を加えて中央値を追従させる。
+    """
+    h, w = padded.shape[0] - (k - 1), padded.shape[1] - (k - 1)
+    kth = (k * k) >> 1
+    out = np.empty((h, w), dtype=np.uint8)
+    for y in prange(h):
+        hist = np.zeros(256, dtype=np.int32)
+        for dy in range(k):
+            for dx in range(k):
+                hist[padded[y + dy, dx]] += 1
+        med, lt = 0, 0
+        while lt + hist[med] <= kth:
+            lt += hist[med]
+            med += 1
+        out[y, 0] = med
+        for x in range(1, w):
+            for dy in range(k):
+                v = padded[y + dy, x - 1]
+                hist[v] -= 1
+                if v < med:
+                    lt -= 1
+                v = padded[y + dy, x + k - 1]
+                hist[v] += 1
+                if v < med:
+                    lt += 1
+            while lt > kth:
+                med -= 1
+                lt -= hist[med]
+            while lt + hist[med] <= kth:
+                lt += hist[med]
+                med += 1
+            out[y, x] = med
+    return out
+
+
+@njit(cache=True)
+def median5x5_u8(padded: np.ndarray) -> np.ndarray:
+    return _median_kxk_u8(padded, 5)
+
+
+@njit(cache=True)
+def median7x7_u8(padded: np.ndarray) -> np.ndarray:
+    return _median_kxk_u8(padded, 7)
+
+
+_MEDIAN_KERNELS = {3: median3x3_u8, 5: median5x5_u8, 7: median7x7_u8}
+
+# parallel=True のカーネルは workqueue スレッディング層 (TBB / OpenMP が
+# 無い環境の既定) では同時呼び出しでプロセスごと落ちるため、
+# Waitress の複数ワーカースレッドからの呼び出しを直列化する
+_median_lock = threading.Lock()
+
+# ヒストグラムの有効範囲がこれ未満なら「偏っている」とみなす
+SKEW_RANGE = 200
+
+
+@njit(cache=True)
+def _pad_reflect_u8(arr: np.ndarray, r: int) -> np.ndarray:
+    """scipy.ndimage の mode="reflect" (d c b a | a b c d) と同じパディング."""
+    h, w = arr.shape
+    out = np.empty((h + 2 * r, w + 2 * r), dtype=np.uint8)
+    for y in range(h + 2 * r):
+        sy = (y - r) % (2 * h)
+        if sy >= h:
+            sy = 2 * h - 1 - sy
+        for x in range(w + 2 * r):
+            sx = (x - r) % (2 * w)
+            if sx >= w:
+                sx = 2 * w - 1 - sx
+            out[y, x] = arr[sy, sx]
+    return out
 
 
-def analyse_histogram(hist: list) -> dict:
-    total = sum(hist)
+def apply_median(arr: np.ndarray, kernel_size: int) -> np.ndarray:
+    kernel = _MEDIAN_KERNELS.get(kernel_size)
+    if kernel is None:
+        raise ValueError(f"unsupported kernel size: {kernel_size}")
+    padded = _pad_reflect_u8(arr.astype(np.uint8, copy=False),
+                             kernel_size // 2)
+    with _median_lock:
+        return kernel(padded)
+
+
+@njit(cache=True)
+def _hist_bounds(h: np.ndarray) -> tuple:
+    """下端・上端からの累積比率が初めて 1% 以上になる輝度 (min, max)."""
+    total = h.sum()
     if total == 0:
-        return {"skewed": False, "min_val": 0, "max_val": 255}
-    cum, min_val = 0, 0
-    for i in range(256):
-        cum += hist[i]
-        if cum / total >= 0.01:
-            min_val = i
-            break
-    cum, max_val = 0, 255
-    for i in range(255, -1, -1):
-        cum += hist[i]
-        if cum / total >= 0.01:
-            max_val = i
-            break
-    return {"skewed": (max_val - min_val) < 200,
-            "min_val": min_val, "max_val": max_val}
-
-
-def apply_level_adjustment(arr: np.ndarray, mn: int, mx: int) -> np.ndarray:
-    r = mx - mn
-    if r <= 0:
-        return arr.copy()
-    return np.clip((arr.astype(np.float64) - mn) / r * 255, 0, 255).astype(
-        np.uint8
-    )
+        return 0, 255
+    min_val = np.argmax(np.cumsum(h) / total >= 0.01)
+    max_val = 255 - np.argmax(np.cumsum(h[::-1]) / total >= 0.01)
+    return min_val, max_val
+
+
+@njit(cache=True)
+def _level_lut(mn: int, mx: int) -> np.ndarray:
+    """レベル調整の変換表 (uint8 入力は 256 値しかない)."""
+    xs = np.arange(256).astype(np.float64)
+    return np.clip((xs - mn) / (mx - mn) * 255, 0, 255).astype(np.uint8)
 
 
-def apply_threshold(arr: np.ndarray, t: int) -> np.ndarray:
-    return np.where(arr <= t, np.uint8(0), np.uint8(255))
+@njit(cache=True)
+def _level_adjust_u8(filtered: np.ndarray) -> tuple:
+    """ヒストグラム → 偏り判定 → レベル調整 (画像の走査は最大 2 回).
+
+    戻り値: (adjusted, raw_hist, hist, min_val, max_val, skewed)
+    調整後ヒストグラムは変換表から 256 ビンだけで求める。
+    """
+    raw_hist = np.zeros(256, dtype=np.int64)
+    for v in filtered.ravel():
+        raw_hist[v] += 1
+    mn, mx = _hist_bounds(raw_hist)
+    skewed = (mx - mn) < SKEW_RANGE
+    if not skewed or mx - mn <= 0:
+        return filtered, raw_hist, raw_hist.copy(), mn, mx, skewed
+
+    lut = _level_lut(mn, mx)
+    adjusted = np.empty_like(filtered)
+    src, dst = filtered.ravel(), adjusted.ravel()
+    for i in range(src.size):
+        dst[i] = lut[src[i]]
+    hist = np.zeros(256, dtype=np.int64)
+    for v in range(256):
+        hist[lut[v]] += raw_hist[v]
+    return adjusted, raw_hist, hist, mn, mx, skewed
+
+
+def process_crop(original: np.ndarray, x0: int, y0: int, x1: int, y1: int,
+                 kernel_size: int) -> tuple:
+    """切り取り → メディアンフィルタ → ヒストグラム → レベル調整.
+
+    戻り値: (cropped, filtered, adjusted, raw_hist, hist,
+             min_val, max_val, skewed)
+    skewed でない場合 adjusted は filtered と同じ内容になる。
+    """
+    # 常に書き込み可能な C 連続配列を渡し、JIT の型シグネチャを 1 つに揃える
+    cropped = original[y0:y1, x0:x1].copy()
+    filtered = apply_median(cropped, kernel_size)
+    adjusted, raw_hist, hist, mn, mx, skewed = _level_adjust_u8(filtered)
+    return (cropped, filtered, adjusted, raw_hist, hist,
+            int(mn), int(mx), bool(skewed))
 
 
-def count_white(arr: np.ndarray) -> int:
-    return int(np.sum(arr == 255))
+# 初回の「適用」で JIT コンパイルが走らないよう、起動時に全カーネルを通しておく
+for _k in _MEDIAN_KERNELS:
+    process_crop(np.zeros((8, 8), dtype=np.uint8), 0, 0, 8, 8, _k)
 
 
 # ============================================================
@@ -130,8 +323,9 @@ def build_original_figure(arr: np.ndarray) -> go.Figure:
     return fig
 
 
-def build_histogram_figure(hist: list, t1=None, t2=None) -> go.Figure:
-    max_h = max(hist) if hist and max(hist) > 0 else 1
+def build_histogram_figure(hist, t1=None, t2=None) -> go.Figure:
+    hist = np.asarray(hist)
+    max_h = int(hist.max()) if hist.size and hist.max() > 0 else 1
     fig = go.Figure(
         data=go.Bar(x=list(range(256)), y=hist,
                     marker_color="black", marker_line_width=0, width=1)
@@ -167,6 +361,15 @@ def build_histogram_figure(hist: list, t1=None, t2=None) -> go.Figure:
     return fig
 
 
+@lru_cache(maxsize=8)
+def _hist_fig_cached(hist: tuple) -> dict:
+    """閾値マーカーなしヒストグラム figure のメモ化版.
+
+    キャッシュ共有されるため、返す dict は呼び出し側で変更しないこと。
+    """
+    return build_histogram_figure(hist).to_plotly_json()
+
+
 # ============================================================
 #  Dash App
 # ============================================================
@@ -177,6 +380,12 @@ app = dash.Dash(
     suppress_callback_exceptions=True,
 )
 
+# 元画像はサーバー側に保持し、dcc.Store にはキーと形状だけを置く
+cache = Cache(app.server, config={
+    "CACHE_TYPE": "SimpleCache",
+    "CACHE_DEFAULT_TIMEOUT": 3600,
+})
+
 # --- Stores ---
 stores = html.Div([
     dcc.Store(id="store-original"),
@@ -434,9 +643,11 @@ def on_upload(contents, filename):
         return [no_update] * 9
     arr = decode_upload_to_gray(contents)
     fig = build_original_figure(arr)
+    key = str(uuid.uuid4())
+    cache.set(key, np.ascontiguousarray(arr, dtype=np.uint8).tobytes())
     hide = {"display": "none"}
     return (
-        arr_to_b64(arr),
+        {"key": key, "shape": list(arr.shape)},
         filename or "unknown",
         fig,
         {"display": "block"},
@@ -500,6 +711,7 @@ def on_relayout(relayout_data):
      Output("adjustment-info", "className"),
      Output("histogram-raw-graph", "figure"),
      Output("histogram-graph", "figure"),
+     Output("threshold-histogram-graph", "figure", allow_duplicate=True),
      Output("section-filter", "style"),
      Output("section-level", "style"),
      Output("section-threshold", "style"),
@@ -511,11 +723,23 @@ def on_relayout(relayout_data):
      State("kernel-size", "value")],
     prevent_initial_call=True,
 )
-def on_apply(n_clicks, original_b64, crop, kernel_size):
-    if not original_b64 or not crop:
-        return [no_update] * 17
-
-    original = b64_to_arr(original_b64)
+def on_apply(n_clicks, original_ref, crop, kernel_size):
+    if not original_ref or not crop:
+        return [no_update] * 18
+
+    raw = cache.get(original_ref["key"])
+    if raw is None:
+        # 期限切れ・サーバー再起動・キャッシュ上限超過で元画像が消えている
+        hide = {"display": "none"}
+        outputs = [no_update] * 18
+        outputs[3] = outputs[4] = None  # 前回の切り取り結果は消す
+        outputs[7] = ("元画像がサーバーに残っていません。"
+                      "画像をもう一度アップロードしてください。")
+        outputs[13:16] = [{"display": "block"}, hide, hide]
+        return outputs
+    original = np.frombuffer(raw, dtype=np.uint8).reshape(
+        original_ref["shape"]
+    )
     h, w = original.shape
 
     x0 = max(0, int(round(min(crop["x0"], crop["x1"]))))
@@ -524,38 +748,30 @@ def on_apply(n_clicks, original_b64, crop, kernel_size):
     y1 = min(h, int(round(max(crop["y0"], crop["y1"]))))
 
     if (x1 - x0) < 2 or (y1 - y0) < 2:
-        return [no_update] * 17
-
-    # Crop
-    cropped = original[y0:y1, x0:x1]
+        return [no_update] * 18
 
-    # Median filter
-    filtered = apply_median(cropped, kernel_size)
+    # Crop + median filter + level adjustment
+    (cropped, filtered, adjusted, raw_hist, histogram,
+     mn, mx, skewed) = process_crop(original, x0, y0, x1, y1, kernel_size)
     filter_msg = (
         f"メディアンフィルタ（{kernel_size}×{kernel_size}）適用済み"
         f" – {x1 - x0}×{y1 - y0} px"
     )
 
-    # Level adjustment
-    raw_hist = compute_histogram(filtered)
-    analysis = analyse_histogram(raw_hist)
-
-    if analysis["skewed"]:
-        adjusted = apply_level_adjustment(
-            filtered, analysis["min_val"], analysis["max_val"]
-        )
+    if skewed:
         info_text = (
             f"ヒストグラムが偏っています"
-            f"（有効範囲: {analysis['min_val']}–{analysis['max_val']} / 255）。"
+            f"（有効範囲: {mn}–{mx} / 255）。"
             f"レベル調整を自動適用しました。"
         )
         info_class = "info-box warning visible"
     else:
-        adjusted = filtered
         info_text = "ヒストグラムは十分に分散しています。レベル調整は不要です。"
         info_class = "info-box info visible"
 
-    histogram = compute_histogram(adjusted)
+    histogram = tuple(histogram.tolist())
+    raw_hist = tuple(raw_hist.tolist())
+    filtered_uri = arr_to_data_uri(filtered)
     show = {"display": "block"}
 
     return (
@@ -563,14 +779,15 @@ def on_apply(n_clicks, original_b64, crop, kernel_size):
         histogram,
         raw_hist,
         arr_to_data_uri(cropped),
-        arr_to_data_uri(filtered),
+        filtered_uri,
         arr_to_data_uri(adjusted),
-        arr_to_data_uri(filtered),  # レベル調整前画像
+        filtered_uri,  # レベル調整前画像
         filter_msg,
         info_text,
         info_class,
-        build_histogram_figure(raw_hist),
-        build_histogram_figure(histogram),
+        _hist_fig_cached(raw_hist),
+        _hist_fig_cached(histogram),
+        _hist_fig_cached(histogram),  # 閾値マーカーは clientside で追加
         show, show, show,
         128, 200,  # reset sliders
     )
@@ -590,7 +807,10 @@ app.clientside_callback(
                     String(t1), String(t2),
                     '二値化1 (t1 = '+t1+')', '二値化2 (t2 = '+t2+')'];
         }
-        var maxH = Math.max(...histogram);
+        var maxH = 0;
+        for (var i = 0; i < histogram.length; i++) {
+            if (histogram[i] > maxH) maxH = histogram[i];
+        }
         if (maxH === 0) maxH = 1;
         var shapes = [];
         var annotations = [];
@@ -606,22 +826,12 @@ app.clientside_callback(
             annotations.push({x:t2, y:maxH*1.12, text:'t2='+t2,
                               showarrow:false, font:{color:'#2980b9', size:11}});
         }
-        var x = []; var y = [];
-        for (var i = 0; i < 256; i++) { x.push(i); y.push(histogram[i]); }
-        var fig = {
-            data: [{type:'bar', x:x, y:y,
-                    marker:{color:'black', line:{width:0}}, width:1}],
-            layout: {
-                shapes: shapes, annotations: annotations,
-                xaxis: {title:'輝度値', range:[-0.5,255.5]},
-                yaxis: {title:'画素数'},
-                bargap: 0,
-                margin: {l:60, r:20, t:20, b:50},
-                plot_bgcolor: '#f8f8f8',
-                height: 260
-            }
-        };
-        return [fig, String(t1), String(t2),
+        // バーのトレースは on_apply で設定済みなので、マーカーだけ差し替える
+        var patch = new window.dash_clientside.Patch()
+            .assign(['layout', 'shapes'], shapes)
+            .assign(['layout', 'annotations'], annotations)
+            .build();
+        return [patch, String(t1), String(t2),
                 '二値化1 (t1 = '+t1+')', '二値化2 (t2 = '+t2+')'];
     }
     """,
@@ -637,73 +847,93 @@ app.clientside_callback(
     State("store-histogram", "data"),
 )
 
-# 4b. Threshold images – server callback (mouseup only) -----------
-@app.callback(
+# 4b. Threshold images + pixel counts – clientside (instant on drag) ----
+#  store-adjusted は生の uint8 バッファ (base64) なので、ブラウザ側で
+#  一度だけデコードして window.dash_clientside にキャッシュし、
+#  スライダー操作ごとの二値化・差分画像生成はすべてクライアントで行う。
+app.clientside_callback(
+    """
+    function(drag1, drag2, val1, val2, adjusted) {
+        var ns = window.dash_clientside;
+        var t1 = (drag1 != null) ? drag1 : val1;
+        var t2 = (drag2 != null) ? drag2 : val2;
+        if (!adjusted || !adjusted.b64) {
+            return Array(6).fill(ns.no_update);
+        }
+        var h = adjusted.shape[0], w = adjusted.shape[1], n = h * w;
+        var c = ns._threshold_cache;
+        // 同じバイト列でも形状が違う (例: 一様な 100×50 と 50×100) ことがある
+        if (!c || c.b64 !== adjusted.b64 || c.h !== h || c.w !== w) {
+            var raw = atob(adjusted.b64);
+            var px = new Uint8Array(n);
+            for (var i = 0; i < n; i++) { px[i] = raw.charCodeAt(i); }
+            // 差分画像 LUT: (分類コード << 8 | 輝度) → RGB
+            //   0: 両方黒=40 / 1: 差分=青(41,128,185)50%ブレンド
+            //   2: t1で黒 かつ t2で白=グレー背景 / 3: 両方白=255
+            var lut = new Uint8Array(1024 * 3);
+            var ov = [41, 128, 185];
+            for (var v = 0; v < 256; v++) {
+                for (var k = 0; k < 3; k++) {
+                    lut[v * 3 + k] = 40;
+                    lut[(256 + v) * 3 + k] = (v + ov[k]) >> 1;
+                    lut[(512 + v) * 3 + k] = v;
+                    lut[(768 + v) * 3 + k] = 255;
+                }
+            }
+            var canvas = document.createElement('canvas');
+            canvas.width = w; canvas.height = h;
+            c = ns._threshold_cache = {
+                b64: adjusted.b64, h: h, w: w, px: px, lut: lut,
+                canvas: canvas, ctx: canvas.getContext('2d')
+            };
+        }
+        var px = c.px, lut = c.lut, ctx = c.ctx;
+        var img1 = ctx.createImageData(w, h);
+        var img2 = ctx.createImageData(w, h);
+        var imgd = ctx.createImageData(w, h);
+        var d1 = img1.data, d2 = img2.data, dd = imgd.data;
+        // 輝度 → 分類コード (bit0: t1で白, bit1: t2で白) を 256 要素で用意し、
+        // 画素ごとの比較を 1 回の表引きにする。画素数もコード別に 1 回で数える
+        var cls = new Uint8Array(256);
+        for (var v = 0; v < 256; v++) {
+            cls[v] = (v > t1 ? 1 : 0) | (v > t2 ? 2 : 0);
+        }
+        var counts = new Uint32Array(4);
+        for (var i = 0, j = 0; i < n; i++, j += 4) {
+            var v = px[i];
+            var code = cls[v];
+            counts[code]++;
+            d1[j] = d1[j + 1] = d1[j + 2] = (code & 1) * 255; d1[j + 3] = 255;
+            d2[j] = d2[j + 1] = d2[j + 2] = (code >> 1) * 255; d2[j + 3] = 255;
+            var k = ((code << 8) | v) * 3;
+            dd[j] = lut[k]; dd[j + 1] = lut[k + 1]; dd[j + 2] = lut[k + 2];
+            dd[j + 3] = 255;
+        }
+        var white1 = counts[1] + counts[3];
+        var white2 = counts[2] + counts[3];
+        var diff = counts[1];
+        function toUri(img) {
+            ctx.putImageData(img, 0, 0);
+            return c.canvas.toDataURL('image/png');
+        }
+        function fmt(x) { return x.toLocaleString('en-US'); }
+        return [toUri(img1), toUri(img2), toUri(imgd),
+                fmt(white1), fmt(white2), fmt(diff)];
+    }
+    """,
     [Output("binary1-img", "src"),
      Output("binary2-img", "src"),
      Output("diff-img", "src"),
      Output("white-count-1", "children"),
      Output("white-count-2", "children"),
      Output("diff-count", "children")],
-    [Input("t1-slider", "value"),
-     Input("t2-slider", "value")],
-    State("store-adjusted", "data"),
+    [Input("t1-slider", "drag_value"),
+     Input("t2-slider", "drag_value"),
+     Input("t1-slider", "value"),
+     Input("t2-slider", "value"),
+     Input("store-adjusted", "data")],
     prevent_initial_call=True,
 )
-def on_threshold(t1, t2, adjusted_b64):
-    if not adjusted_b64:
-        return [no_update] * 6
-
-    adjusted = b64_to_arr(adjusted_b64)
-
-    bin1 = apply_threshold(adjusted, t1)
-    bin2 = apply_threshold(adjusted, t2)
-
-    # 差分画像: グレー背景に差分領域を青50%アルファで重畳
-    h_img, w_img = adjusted.shape
-    diff_rgba = np.zeros((h_img, w_img, 4), dtype=np.uint8)
-    # 背景: グレースケール画像をそのまま
-    diff_rgba[:, :, 0] = adjusted
-    diff_rgba[:, :, 1] = adjusted
-    diff_rgba[:, :, 2] = adjusted
-    diff_rgba[:, :, 3] = 255
-
-    mask_diff = (bin1 == 255) & (bin2 == 0)  # t1で白 かつ t2で黒
-    # 青(41,128,185)を50%アルファでブレンド
-    overlay_r, overlay_g, overlay_b, alpha = 41, 128, 185, 0.5
-    blend_r = (adjusted * (1 - alpha) + overlay_r * alpha).astype(np.uint8)
-    blend_g = (adjusted * (1 - alpha) + overlay_g * alpha).astype(np.uint8)
-    blend_b = (adjusted * (1 - alpha) + overlay_b * alpha).astype(np.uint8)
-    diff_rgba[mask_diff, 0] = blend_r[mask_diff]
-    diff_rgba[mask_diff, 1] = blend_g[mask_diff]
-    diff_rgba[mask_diff, 2] = blend_b[mask_diff]
-
-    # 両方白
-    mask_both_white = (bin1 == 255) & (bin2 == 255)
-    diff_rgba[mask_both_white, 0] = 255
-    diff_rgba[mask_both_white, 1] = 255
-    diff_rgba[mask_both_white, 2] = 255
-    # 両方黒
-    mask_both_black = (bin1 == 0) & (bin2 == 0)
-    diff_rgba[mask_both_black, 0] = 40
-    diff_rgba[mask_both_black, 1] = 40
-    diff_rgba[mask_both_black, 2] = 40
-
-    diff_count = int(np.sum(mask_diff))
-
-    # 差分画像をPNG化
-    diff_buf = io.BytesIO()
-    Image.fromarray(diff_rgba).save(diff_buf, format="PNG")
-    diff_uri = f"data:image/png;base64,{base64.b64encode(diff_buf.getvalue()).decode()}"
-
-    return (
-        arr_to_data_uri(bin1),
-        arr_to_data_uri(bin2),
-        diff_uri,
-        f"{count_white(bin1):,}",
-        f"{count_white(bin2):,}",
-        f"{diff_count:,}",
-    )
 
 
 # 5. Add to table -----------------------------------------------
@@ -741,6 +971,14 @@ def on_add_table(n_clicks, filename, t1, t2, cnt1, cnt2, table_data):
 
 
 # 6. CSV export -------------------------------------------------
+_CSV_SPECIAL = re.compile(r'[,"\r\n]')
+
+
+def _csv_quote(s: str) -> str:
+    """カンマを含む数値文字列を csv.writer (QUOTE_MINIMAL) と同様に引用する."""
+    return f'"{s}"' if "," in s else s
+
+
 @app.callback(
     Output("download-csv", "data"),
     Input("export-btn", "n_clicks"),
@@ -750,18 +988,31 @@ def on_add_table(n_clicks, filename, t1, t2, cnt1, cnt2, table_data):
 def on_export(n_clicks, table_data):
     if not table_data:
         return no_update
-    buf = io.StringIO()
-    writer = csv.writer(buf)
-    writer.writerow(["ファイル名", "閾値1(t1)", "閾値2(t2)",
-                     "白画素数(t1)", "白画素数(t2)",
-                     "差分(t1-t2)", "差分/t1(%)"])
-    for row in table_data:
-        writer.writerow([row["filename"],
-                        row.get("t1", ""), row.get("t2", ""),
-                        row["count1"], row["count2"],
-                        row.get("diff", ""), row.get("ratio", "")])
+    header = ["ファイル名", "閾値1(t1)", "閾値2(t2)",
+              "白画素数(t1)", "白画素数(t2)",
+              "差分(t1-t2)", "差分/t1(%)"]
+    if any(_CSV_SPECIAL.search(str(row["filename"])) for row in table_data):
+        # ファイル名に引用が必要な文字がある場合は csv モジュールに任せる
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(header)
+        for row in table_data:
+            writer.writerow([row["filename"],
+                            row.get("t1", ""), row.get("t2", ""),
+                            row["count1"], row["count2"],
+                            row.get("diff", ""), row.get("ratio", "")])
+        content = buf.getvalue()
+    else:
+        # 画素数は "1,234" 形式なので、csv.writer と同じく引用符で囲む
+        q = _csv_quote
+        content = ",".join(header) + "\r\n" + "".join(
+            f"{row['filename']},{row.get('t1', '')},{row.get('t2', '')},"
+            f"{q(row['count1'])},{q(row['count2'])},"
+            f"{q(row.get('diff', ''))},{row.get('ratio', '')}\r\n"
+            for row in table_data
+        )
     return dict(
-        content="\ufeff" + buf.getvalue(),
+        content="\ufeff" + content,
         filename="image_analysis_results.csv",
         type="text/csv",
     )
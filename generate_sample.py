@@ -25,14 +25,14 @@ region_centers = [
     (540, 100),   # 右上: 山3
 ]
 
-structured = np.zeros((height, width), dtype=np.uint8)
-
-for y in range(height):
-    for x in range(width):
-        dists = [np.sqrt((x - cx)**2 + (y - cy)**2) for cx, cy in region_centers]
-        chosen = int(np.argmin(dists))
-        val = rng.normal(means[chosen], stds[chosen])
-        structured[y, x] = int(np.clip(val, 80, 255))
+yy, xx = np.mgrid[:height, :width]
+dists = np.stack([(xx - cx)**2 + (yy - cy)**2 for cx, cy in region_centers])
+chosen = np.argmin(dists, axis=0)
+# 画素ごとに rng.normal(mean, std) を引くのと同じ乱数列
+noise = rng.normal(0, 1, (height, width))
+mu = np.array(means)[chosen]
+sig = np.array(stds)[chosen]
+structured = np.clip(mu + sig * noise, 80, 255).astype(np.uint8)
 
 # 境界を滑らかにする軽いぼかし(半径小さめ)
 img = Image.fromarray(structured)